@@ -1,14 +1,43 @@
 import os
+import time
+import textwrap
+import threading
 from dotenv import load_dotenv
 from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.embeddings import Embeddings
 from langchain_chroma import Chroma
 from langchain_huggingface import HuggingFaceEmbeddings
 import torch
 
+# 必须在导入下列模块之前加载 .env：它们在导入时读取 CONTEXT_* / GATE_* / PREFETCH_* 等配置
 load_dotenv()
 
+from context_assembler import ContextAssembler, TokenCounter, resolve_tokenizer
+from segment_gate import SegmentGate
+from speculative_prefetch import SpeculativePrefetcher
+from idle_unloader import IdleResourceManager, LazyVectorStore
+
+
+class SerializedEmbeddings(Embeddings):
+    """
+    给 Embedding 调用加锁：预取线程与主线程会同时使用 bge-m3，
+    而其 fast tokenizer 不是线程安全的。锁与 TokenCounter 共用。
+    """
+
+    def __init__(self, inner, lock):
+        self.inner = inner
+        self.lock = lock
+
+    def embed_documents(self, texts):
+        with self.lock:
+            return self.inner.embed_documents(texts)
+
+    def embed_query(self, text):
+        with self.lock:
+            return self.inner.embed_query(text)
+
 
 class LectureAgentCore:
     def __init__(self):
@@ -19,37 +48,43 @@ class LectureAgentCore:
         # 使用 BAAI/bge-m3 模型将文本转换为向量，支持中英文混合
 
         if torch.cuda.is_available():
-            device_type = 'cuda'
+            self.device_type = 'cuda'
             print("Detected NVIDIA GPU (CUDA)")
         elif torch.backends.mps.is_available():
-            device_type = 'mps'  # Apple Silicon 的加速器
+            self.device_type = 'mps'  # Apple Silicon 的加速器
             print("Detected Apple Silicon (MPS)")
         else:
-            device_type = 'cpu'
+            self.device_type = 'cpu'
             print("Using CPU")
 
-        self.embeddings = HuggingFaceEmbeddings(
-            model_name="BAAI/bge-m3",
-            model_kwargs={'device': device_type}
-        )
-        # 加载本地持久化的数据库
-        self.vector_db = Chroma(
-            persist_directory="./chroma_db",
-            embedding_function=self.embeddings,
-            collection_name="fintech_knowledge"
-        )
+        # bge-m3 (含分词器) 的全局锁：Embedding 与本地 Token 计数串行执行
+        self.model_lock = threading.RLock()
+
+        # 模型与数据库由资源管理器持有：低内存模式下空闲时卸载，下次访问 vector_db 时透明重载
+        self.resources = IdleResourceManager(self._load_retrieval)
+        self.resources.acquire()
+        self.vector_db = LazyVectorStore(self.resources)
 
         # 2. LLM 初始化 (大脑)
         # 温度设为 0.1 以保证学术输出的严谨性和一致性
+        # GEMINI_BASE_URL 可指向本地替身服务器 (test_scripts/gemini_standin_server.py)，用于压测
+        llm_kwargs = {}
+        base_url = os.getenv("GEMINI_BASE_URL")
+        if base_url:
+            llm_kwargs["base_url"] = base_url
+            print(f"🔌 Custom LLM endpoint: {base_url}")
         self.llm = ChatGoogleGenerativeAI(
             model=os.getenv("MODEL_NAME", "gemini-3-flash-preview"),  # 建议在 .env 中管理版本
             google_api_key=os.getenv("GOOGLE_API_KEY"),
             temperature=0.1,
+            **llm_kwargs,
         )
 
         # 3. System Prompt (核心指令集)
         # 包含：角色定义、RAG上下文注入、任务指令、防御机制、格式约束
-        self.system_prompt = """
+        # dedent 去掉源码缩进，避免每次调用都为空白字符付费；
+        # 未处理的原文保留为 baseline_prompt，用于统计优化前的 Prompt 大小
+        self.baseline_prompt = """
         You are a strict academic research assistant in Quantitative Finance.
 
         [CONTEXT FROM LOCAL DATABASE]
@@ -87,50 +122,108 @@ class LectureAgentCore:
         [USER INPUT]
         {input_text}
         """
+        self.system_prompt = textwrap.dedent(self.baseline_prompt).strip()
 
         self.prompt = ChatPromptTemplate.from_template(self.system_prompt)
         self.chain = self.prompt | self.llm | StrOutputParser()
 
+        # 4. 上下文组装器 (Token 预算内自适应检索 + 压缩 + 去重)
+        self.assembler = ContextAssembler(
+            self.vector_db,
+            counter=TokenCounter(resolve_tokenizer(self.resources.embeddings.inner), self.model_lock),
+        )
+
+        # 5. 本地门控 (闲聊片段不调用 LLM)
+        self.gate = SegmentGate(self.vector_db)
+
+        # 6. 推测式预取 (未闭合 <ai> 标签的检索结果提前在后台算好)
+        self.prefetcher = SpeculativePrefetcher(self.prefetch_segment)
+
+    def _load_retrieval(self):
+        """加载 bge-m3 与本地持久化的数据库，返回 (embeddings, vector_db)"""
+        embeddings = SerializedEmbeddings(HuggingFaceEmbeddings(
+            model_name="BAAI/bge-m3",
+            model_kwargs={'device': self.device_type}
+        ), self.model_lock)
+        vector_db = Chroma(
+            persist_directory="./chroma_db",
+            embedding_function=embeddings,
+            collection_name="fintech_knowledge"
+        )
+        return embeddings, vector_db
+
+    def assemble_context(self, raw_text):
+        """在 Token 预算内为 raw_text 组装检索上下文，返回 (context_str, report)"""
+        return self.assembler.assemble(raw_text, self.system_prompt, raw_text, self.baseline_prompt)
+
+    def prefetch_segment(self, raw_text):
+        """
+        预取任务 (后台线程)：门控判定 + 上下文组装，返回 (classification, context_str, report)。
+        门控的向量检索也在这里完成，命中后关键路径上只剩 LLM 调用。
+        """
+        classification = self.gate.classify(raw_text) if self.gate.enabled else None
+        if classification and self.gate.would_skip(*classification):
+            return classification, None, None
+        context_str, report = self.assemble_context(raw_text)
+        return classification, context_str, report
+
     def generate_note(self, raw_text):
         # 1. 输入预检查：太短的文本直接忽略，节省 API 调用
         if not raw_text or len(raw_text.strip()) < 3:
             return raw_text
 
-        # 2. RAG 检索流程
-        try:
-            # 检查数据库是否为空，防止冷启动报错
-            if self.vector_db._collection.count() == 0:
-                context_str = "No local context available (Database is empty)."
-            else:
-                # 使用带阈值的检索，过滤掉相关性低的内容
-                retriever = self.vector_db.as_retriever(
-                    search_type="similarity_score_threshold",
-                    search_kwargs={"score_threshold": 0.3, "k": 2}
-                )
-                docs = retriever.invoke(raw_text)
-                if docs:
-                    context_str = "\n".join([f"- {d.page_content}" for d in docs])
-                else:
-                    context_str = "No relevant context found in local database."
+        # 1.5 推测式预取：标签闭合前已在后台算好的门控判定与上下文
+        prefetched = self.prefetcher.take(raw_text)
+        classification, context_str, report = None, None, None
+        if prefetched:
+            (classification, context_str, report), saved_ms = prefetched
 
-        except Exception as e:
-            # 检索失败不应阻断主流程，降级为无 RAG 模式
-            context_str = f"Context retrieval skipped: {str(e)}"
+        # 1.6 本地门控：高置信度的闲聊直接原样返回，省掉一次 API 往返
+        skip, verdict = self.gate.should_skip(raw_text, classification)
+        if skip:
+            print(f"⏭️  Gate skipped: {raw_text[:30]}... (Chat/Nonsense, no API call)")
+            return raw_text
+
+        # 2. RAG 检索流程 (在 Token 预算内组装上下文)
+        if context_str is not None:
+            print(f"🔮 Prefetch hit: saved {saved_ms:.0f}ms ({self.prefetcher.summary()})")
+        else:
+            try:
+                context_str, report = self.assemble_context(raw_text)
+            except Exception as e:
+                # 检索失败不应阻断主流程，降级为无 RAG 模式
+                context_str = f"Context retrieval skipped: {str(e)}"
 
         # 3. LLM 生成流程
         try:
+            llm_start = time.perf_counter()
             response = self.chain.invoke({
                 "context": context_str,
                 "input_text": raw_text
             })
+            if report:
+                self._print_report(report, (time.perf_counter() - llm_start) * 1000)
 
             # 4. 鲁棒性检查：如果模型判断为闲聊，则原样返回
-            if "SKIP_PROCESSING" in response:
-                print(f"⏭️  Skipped: {raw_text[:30]}... (Chat/Nonsense)")
+            llm_skipped = "SKIP_PROCESSING" in response
+            self.gate.record_llm_decision(verdict, llm_skipped)
+            if llm_skipped:
+                print(f"⏭️  Skipped: {raw_text[:30]}... (Chat/Nonsense, {self.gate.summary()})")
                 return raw_text
 
             return response
 
         except Exception as e:
             print(f"❌ Error: {e}")
-            return raw_text
\ No newline at end of file
+            return raw_text
+
+    @staticmethod
+    def _print_report(report, llm_ms):
+        # 每次调用打印 Prompt 体积 (组装前 -> 组装后) 与各阶段耗时
+        print(
+            f"📏 Prompt: {report['raw_tokens']} -> {report['prompt_tokens']} tokens "
+            f"(budget {report['budget']}, k={report['k']}/{report['retrieved']}, "
+            f"dropped {report['dropped']}, compressed {report['compressed']}) | "
+            f"retrieval {report['retrieval_ms']:.0f}ms, assembly {report['assembly_ms']:.0f}ms, "
+            f"LLM {llm_ms:.0f}ms"
+        )
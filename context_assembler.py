@@ -0,0 +1,294 @@
+import os
+import re
+import time
+import logging
+import threading
+
+# --- Token 预算配置 (可在 .env 中覆盖) ---
+# 整个 Prompt (指令模板 + 检索上下文 + 用户输入) 的 Token 上限。
+# 默认值接近原先 k=2 的 Prompt (模板约 500 + 输入 + 2 个片段)，不额外多注入上下文
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1400"))
+# 单个检索片段的 Token 上限，超出部分会被压缩为最相关的句子
+CONTEXT_CHUNK_TOKENS = int(os.getenv("CONTEXT_CHUNK_TOKENS", "300"))
+# 自适应 k 的上限 (实际 k 由剩余预算决定；检索时另多取 2 个作为去重余量，不受此上限限制)
+CONTEXT_MAX_K = int(os.getenv("CONTEXT_MAX_K", "6"))
+# 剩余预算低于此值时不再追加片段 (太短的片段对模型没有意义)
+CONTEXT_MIN_CHUNK_TOKENS = 48
+# 相关性阈值 (与原先 similarity_score_threshold 保持一致)
+SCORE_THRESHOLD = 0.3
+# 两个片段词集合的 Jaccard 相似度超过此值即视为冗余
+REDUNDANCY_THRESHOLD = 0.8
+# 优化前的固定检索数量，用于计算 report 中的 raw_tokens
+BASELINE_K = 2
+
+# --- 分词正则 ---
+# 中日韩字符按单字计 Token，其余按单词/符号计
+REGEX_CJK = re.compile(r'[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af\uf900-\ufaff]')
+REGEX_WORD = re.compile(r'[A-Za-z0-9_]+|[^\sA-Za-z0-9_]')
+REGEX_TERM = re.compile(r'[a-z0-9_]{2,}')
+# 句子切分：中文标点 (含逗号) 后无需空格即可切开，英文句末标点后需跟空白
+REGEX_SENTENCE = re.compile(r'(?<=[。！？；，])\s*|(?<=[.!?;])\s+')
+# Markdown 表格的分隔行 (| --- | :---: |)
+REGEX_TABLE_RULE = re.compile(r'^\s*\|?\s*:?-{3,}')
+
+STOPWORDS = {
+    "the", "is", "are", "was", "of", "and", "or", "to", "in", "on", "for", "a", "an",
+    "it", "this", "that", "with", "as", "by", "be", "at", "from", "what", "how", "why",
+}
+
+
+def estimate_tokens(text):
+    """
+    本地 Token 估算 (无需联网)：CJK 每字约 1 Token，英文约 4 字符 1 Token，符号各计 1。
+    """
+    if not text:
+        return 0
+    cjk_count = len(REGEX_CJK.findall(text))
+    rest = REGEX_CJK.sub(" ", text)
+    tokens = cjk_count
+    for word in REGEX_WORD.findall(rest):
+        tokens += max(1, (len(word) + 3) // 4) if word[0].isalnum() or word[0] == "_" else 1
+    return tokens
+
+
+def resolve_tokenizer(embeddings):
+    """
+    尝试从 HuggingFaceEmbeddings 中取出 bge-m3 的本地分词器，
+    取不到时返回 None (调用方降级为 estimate_tokens)。
+    """
+    client = getattr(embeddings, "_client", None) or getattr(embeddings, "client", None)
+    return getattr(client, "tokenizer", None)
+
+
+class TokenCounter:
+    """
+    本地 Token 计数器：优先使用 bge-m3 分词器，失败时回退到启发式估算。
+
+    HF 的 fast tokenizer 不是线程安全的 (并发调用会抛 "Already borrowed")，
+    因此与 Embedding 共用同一把锁 (由调用方传入)。
+    """
+
+    def __init__(self, tokenizer=None, lock=None):
+        self.tokenizer = tokenizer
+        self.lock = lock or threading.RLock()
+
+    def count(self, text):
+        if not text:
+            return 0
+        if self.tokenizer is not None:
+            try:
+                with self.lock:
+                    return len(self.tokenizer.encode(text, add_special_tokens=False))
+            except Exception as e:
+                # 单次失败只降级本次调用，不永久停用分词器
+                logging.debug(f"Tokenizer failed, using estimate: {e}")
+        return estimate_tokens(text)
+
+
+def extract_terms(text):
+    """提取用于相关性/冗余判断的词集合：英文小写单词 + 中文双字组"""
+    lowered = text.lower()
+    terms = {t for t in REGEX_TERM.findall(lowered) if t not in STOPWORDS}
+    cjk = "".join(REGEX_CJK.findall(text))
+    terms.update(cjk[i:i + 2] for i in range(len(cjk) - 1))
+    return terms
+
+
+class ContextAssembler:
+    """
+    上下文组装器：在固定的 Token 预算内，为 Prompt 挑选、压缩并去重检索片段。
+
+    流程：计算模板与输入占用 -> 根据剩余预算自适应 k -> 检索 ->
+    丢弃冗余片段 -> 超长片段压缩为最相关的句子 -> 拼接。
+    """
+
+    def __init__(self, vector_db, counter=None, budget=CONTEXT_TOKEN_BUDGET,
+                 chunk_tokens=CONTEXT_CHUNK_TOKENS, max_k=CONTEXT_MAX_K):
+        self.vector_db = vector_db
+        self.counter = counter or TokenCounter()
+        self.budget = budget
+        self.chunk_tokens = chunk_tokens
+        self.max_k = max_k
+
+    def assemble(self, query, template, input_text, baseline_template=None):
+        """
+        返回 (context_str, report)。report 记录组装前后的 Token 数与耗时，供调用方打印。
+        raw_tokens 按优化前的做法估算：baseline_template (未 dedent 的原模板，缺省同 template)
+        + 输入 + 前 BASELINE_K 个原始片段。
+        """
+        start = time.perf_counter()
+        report = {
+            "budget": self.budget,
+            "k": 0,
+            "retrieved": 0,
+            "dropped": 0,
+            "compressed": 0,
+            "raw_tokens": 0,
+            "prompt_tokens": 0,
+            "retrieval_ms": 0.0,
+            "assembly_ms": 0.0,
+        }
+
+        input_tokens = self.counter.count(input_text)
+        fixed_tokens = self.counter.count(template) + input_tokens
+        available = self.budget - fixed_tokens
+        baseline_fixed = self.counter.count(baseline_template or template) + input_tokens
+
+        # 1. 预算已被指令模板 + 输入耗尽：跳过检索 (连 Embedding 的开销一并省掉)
+        if available < CONTEXT_MIN_CHUNK_TOKENS:
+            context_str = "Context omitted: token budget exhausted by the input segment."
+            logging.warning(f"⚠️ Input segment alone uses {fixed_tokens} tokens (budget {self.budget})")
+            return self._finish(context_str, baseline_fixed, fixed_tokens, report, start)
+
+        # 2. 检查数据库是否为空，防止冷启动报错
+        if self.vector_db._collection.count() == 0:
+            context_str = "No local context available (Database is empty)."
+            context_tokens = self.counter.count(context_str)
+            return self._finish(context_str, baseline_fixed + context_tokens, fixed_tokens + context_tokens, report, start)
+
+        # 3. 自适应 k：剩余预算能容纳多少个满额片段，再多取 2 个作为去重余量
+        k = max(1, min(self.max_k, available // self.chunk_tokens))
+        retrieval_start = time.perf_counter()
+        results = self.vector_db.similarity_search_with_relevance_scores(
+            query, k=k + 2, score_threshold=SCORE_THRESHOLD
+        )
+        report["retrieval_ms"] = (time.perf_counter() - retrieval_start) * 1000
+        report["retrieved"] = len(results)
+
+        docs = [doc for doc, _score in results]
+        # 优化前：直接拼接前 BASELINE_K 个原始片段 (检索结果按相关性排序，与原先 k=2 的结果一致)
+        raw_context = "\n".join(f"- {d.page_content}" for d in docs[:BASELINE_K])
+        raw_tokens = baseline_fixed + self.counter.count(raw_context or "No relevant context found in local database.")
+
+        # 4. 贪心挑选：按相关性顺序加入，直到预算或 k 用完
+        query_terms = extract_terms(query)
+        selected = []
+        selected_terms = []
+        remaining = available
+        for doc in docs:
+            if len(selected) >= k or remaining < CONTEXT_MIN_CHUNK_TOKENS:
+                break
+
+            text = doc.page_content.strip()
+            terms = extract_terms(text)
+            if any(self._jaccard(terms, seen) >= REDUNDANCY_THRESHOLD for seen in selected_terms):
+                report["dropped"] += 1
+                continue
+
+            limit = min(self.chunk_tokens, remaining)
+            tokens = self.counter.count(text)
+            if tokens > limit:
+                text = self.compress(text, query_terms, limit)
+                if not text:
+                    continue
+                tokens = self.counter.count(text)
+                report["compressed"] += 1
+
+            selected.append(f"- {text}")
+            selected_terms.append(terms)
+            remaining -= tokens + 1
+
+        report["k"] = len(selected)
+
+        if selected:
+            context_str = "\n".join(selected)
+        else:
+            context_str = "No relevant context found in local database."
+
+        prompt_tokens = fixed_tokens + self.counter.count(context_str)
+        return self._finish(context_str, raw_tokens, prompt_tokens, report, start)
+
+    def compress(self, text, query_terms, limit):
+        """
+        将超长片段压缩为与查询最相关的句子 (保持原文顺序)。
+        Markdown 表格保留表头与分隔行，其余行按相关性取舍；
+        若没有任何完整的句子放得下 (无标点的长段落)，则截断最相关的那一句。
+        """
+        lines = text.split("\n")
+        units = []  # (line_idx, text, pinned)
+        seen = set()  # 片段内部重复的句子/表头只保留第一次出现
+        for idx, line in enumerate(lines):
+            if not line.strip():
+                continue
+            is_table = line.lstrip().startswith("|")
+            if is_table:
+                next_line = lines[idx + 1] if idx + 1 < len(lines) else ""
+                pinned = bool(REGEX_TABLE_RULE.match(line) or REGEX_TABLE_RULE.match(next_line))
+                candidates = [(line, pinned)]
+            else:
+                candidates = [(s.strip(), False) for s in REGEX_SENTENCE.split(line) if s.strip()]
+            for unit, pinned in candidates:
+                if unit in seen:
+                    continue
+                seen.add(unit)
+                units.append((idx, unit, pinned))
+
+        scored = []
+        for pos, (_idx, unit, pinned) in enumerate(units):
+            terms = extract_terms(unit)
+            overlap = len(terms & query_terms) / (len(terms) ** 0.5) if terms else 0.0
+            # 表头优先级最高；同分时越靠前越优先
+            scored.append((float("inf") if pinned else overlap, -pos, pos))
+        scored.sort(reverse=True)
+
+        keep = set()
+        used = 0
+        # 相关句优先；剩余预算再按原文顺序补齐 (相当于截断)
+        for _score, _neg, pos in scored:
+            cost = self.counter.count(units[pos][1]) + 1
+            if used + cost > limit:
+                continue
+            keep.add(pos)
+            used += cost
+
+        texts = {pos: unit for pos, (_idx, unit, _pinned) in enumerate(units)}
+        if not keep and units:
+            # 优先截断最相关的正文句，而不是放不下的表头
+            best = next((pos for score, _neg, pos in scored if score != float("inf")), scored[0][2])
+            texts[best] = self.truncate(units[best][1], limit - 1)
+            if texts[best]:
+                keep.add(best)
+
+        parts = []
+        prev_pos = None
+        for pos in sorted(keep):
+            line_idx = units[pos][0]
+            unit = texts[pos]
+            if prev_pos is None:
+                parts.append(unit)
+            else:
+                gap = "" if pos == prev_pos + 1 else " …"
+                if line_idx != units[prev_pos][0]:
+                    sep = "\n"
+                else:
+                    # 中文标点后原本就没有空格
+                    sep = "" if texts[prev_pos][-1] in "。！？；，" and not gap else " "
+                parts.append(f"{gap}{sep}{unit}")
+            prev_pos = pos
+        return "".join(parts)
+
+    def truncate(self, text, limit):
+        """按 Token 上限截断文本 (二分查找最长前缀)，末尾加省略号"""
+        if self.counter.count(text) <= limit:
+            return text
+        lo, hi = 0, len(text)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.counter.count(text[:mid].rstrip() + " …") <= limit:
+                lo = mid
+            else:
+                hi = mid - 1
+        return text[:lo].rstrip() + " …" if lo else ""
+
+    @staticmethod
+    def _jaccard(a, b):
+        if not a or not b:
+            return 0.0
+        return len(a & b) / len(a | b)
+
+    @staticmethod
+    def _finish(context_str, raw_tokens, prompt_tokens, report, start):
+        report["raw_tokens"] = raw_tokens
+        report["prompt_tokens"] = prompt_tokens
+        report["assembly_ms"] = (time.perf_counter() - start) * 1000 - report["retrieval_ms"]
+        return context_str, report
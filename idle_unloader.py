@@ -0,0 +1,159 @@
+import os
+import gc
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+import torch
+
+# --- 低内存模式配置 (可在 .env 中覆盖) ---
+# 开启后，空闲超时会卸载 bge-m3 并释放 ChromaDB，下次使用时透明重载
+LOW_MEMORY_MODE = os.getenv("LOW_MEMORY_MODE", "0") == "1"
+# 空闲多久后卸载 (秒)
+IDLE_UNLOAD_SECONDS = float(os.getenv("IDLE_UNLOAD_SECONDS", "600"))
+# 检测到含 <ai> 的笔记被修改时，提前在后台重载 (用户闭合标签前就把模型准备好)
+PRELOAD_ON_EDIT = os.getenv("PRELOAD_ON_EDIT", "1") != "0"
+
+
+class LazyVectorStore:
+    """
+    Chroma 的透明代理：访问任何属性前先确保资源已加载，
+    因此 ContextAssembler / SegmentGate 无需感知卸载与重载。
+    方法调用在整个执行期间都登记为"使用中"，maybe_unload 不会在检索途中卸载模型。
+    """
+
+    def __init__(self, manager):
+        self._manager = manager
+
+    def __getattr__(self, name):
+        attr = getattr(self._manager.acquire(), name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with self._manager.using() as vector_db:
+                return getattr(vector_db, name)(*args, **kwargs)
+
+        return call
+
+
+class IdleResourceManager:
+    """
+    管理 Embedding 模型与向量数据库的生命周期：
+    空闲超时后卸载以释放内存 (8GB 笔记本上约 2GB+)，再次使用时自动重载并记录耗时。
+    """
+
+    def __init__(self, loader, enabled=LOW_MEMORY_MODE, idle_seconds=IDLE_UNLOAD_SECONDS):
+        # loader() -> (embeddings, vector_db)
+        self.loader = loader
+        self.enabled = enabled
+        self.idle_seconds = idle_seconds
+        self.lock = threading.RLock()
+        self.embeddings = None
+        self.vector_db = None
+        self.last_used = time.monotonic()
+        self.in_use = 0  # 正在执行的调用数 (using() 上下文)
+        self.warming = False
+        self.stats = {"loads": 0, "unloads": 0, "preemptive": 0, "reload_ms_total": 0.0, "last_reload_ms": 0.0}
+
+    @property
+    def loaded(self):
+        return self.vector_db is not None
+
+    def acquire(self):
+        """返回已加载的 vector_db (必要时重载)，并刷新空闲计时"""
+        with self.lock:
+            if self.vector_db is None:
+                self._load()
+            self.last_used = time.monotonic()
+            return self.vector_db
+
+    @contextmanager
+    def using(self):
+        """
+        在上下文内使用 vector_db：期间计入 in_use，maybe_unload 不会卸载。
+        锁只保护加载与计数，不串行化调用本身 (Embedding 另有 model_lock)。
+        """
+        with self.lock:
+            vector_db = self.acquire()
+            self.in_use += 1
+        try:
+            yield vector_db
+        finally:
+            with self.lock:
+                self.in_use -= 1
+                self.last_used = time.monotonic()
+
+    def _load(self):
+        start = time.perf_counter()
+        self.embeddings, self.vector_db = self.loader()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        # 第一次加载是启动开销，不计入重载统计
+        if self.stats["loads"] > 0:
+            self.stats["reload_ms_total"] += elapsed_ms
+            self.stats["last_reload_ms"] = elapsed_ms
+            logging.info(f"♻️ Retrieval resources reloaded in {elapsed_ms:.0f}ms ({self.summary()})")
+        self.stats["loads"] += 1
+
+    def maybe_unload(self):
+        """守护进程每轮调用：低内存模式下空闲超时则卸载"""
+        if not self.enabled or not self.loaded:
+            return
+        if time.monotonic() - self.last_used < self.idle_seconds:
+            return
+        # 正在加载 (例如后台预热) 时不等锁，下一轮再试
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            # 仍有调用在执行 (例如后台预取正在检索) 时不卸载
+            if self.in_use == 0:
+                self._unload()
+        finally:
+            self.lock.release()
+
+    def _unload(self):
+        client = getattr(self.vector_db, "_client", None)
+        self.embeddings = None
+        self.vector_db = None
+        try:
+            # chromadb 会缓存 System 实例，不清理的话数据库句柄不会释放
+            if client is not None:
+                client.clear_system_cache()
+        except Exception as e:
+            logging.warning(f"⚠️ Failed to release ChromaDB client: {e}")
+
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        elif torch.backends.mps.is_available() and hasattr(torch, "mps"):
+            torch.mps.empty_cache()
+
+        self.stats["unloads"] += 1
+        logging.info(f"💤 Idle for {self.idle_seconds:.0f}s: embedding model and DB unloaded")
+
+    def warm_up(self):
+        """预先在后台重载 (例如含 <ai> 的笔记刚被修改)，不阻塞扫描循环"""
+        if not self.enabled or self.loaded or self.warming:
+            return
+        self.warming = True
+        self.stats["preemptive"] += 1
+
+        def _run():
+            try:
+                self.acquire()
+            except Exception as e:
+                logging.error(f"❌ Pre-emptive reload failed: {e}")
+            finally:
+                self.warming = False
+
+        threading.Thread(target=_run, name="warm-up", daemon=True).start()
+
+    def summary(self):
+        reloads = max(0, self.stats["loads"] - 1)
+        avg_ms = self.stats["reload_ms_total"] / reloads if reloads else 0.0
+        return (
+            f"{reloads} reloads (avg {avg_ms:.0f}ms, last {self.stats['last_reload_ms']:.0f}ms), "
+            f"{self.stats['unloads']} unloads, {self.stats['preemptive']} pre-emptive"
+        )
@@ -3,17 +3,24 @@ import os
 import re
 import logging
 from agent_core import LectureAgentCore
+from idle_unloader import PRELOAD_ON_EDIT
 
 # --- 基础配置 ---
 OBSIDIAN_PATH = r"./test_notes"  # ⚠️ Beta测试时请确认此路径指向你的克隆库
 LOG_FILE = "./logs/agent_runtime.log"
 
+# 记录每个笔记的修改时间，用于低内存模式下的预先重载
+LAST_MTIMES = {}
+
 # --- 触发标签配置 ---
 START_TAG = "<ai>"
 END_TAG = "</ai>"
 # DOTALL 模式确保 . 能匹配换行符，捕获多行内容
 PATTERN = re.compile(f"{re.escape(START_TAG)}(.*?){re.escape(END_TAG)}", re.DOTALL)
 
+# 空行之后仍有内容：说明未闭合标签后面还跟着笔记的其他部分
+REGEX_PARAGRAPH_BREAK = re.compile(r'\n[ \t]*\n\s*\S')
+
 # --- 结构保护正则 ---
 # 匹配图片 ![[...]]
 REGEX_IMG = re.compile(r'(!\[\[.*?\]\])')
@@ -96,11 +103,88 @@ def scan_and_process(agent):
                 process_segment(agent, file_path)
 
 
+def prepare_segment(raw_segment):
+    """
+    结构识别 + 内容保护：返回 (is_callout, callout_header, protector, masked_text)。
+    闭合标签的处理与推测式预取共用此函数，保证两边送给 Agent 的文本完全一致。
+    """
+    # --- Step 1: 结构识别 (Callout vs 普通文本) ---
+    is_callout = False
+    callout_header = ""
+    processing_text = raw_segment
+
+    header_match = REGEX_CALLOUT_HEADER.match(raw_segment)
+
+    if header_match:
+        is_callout = True
+        raw_header = raw_segment.split('\n')[0].strip()
+        # 规范化 Callout 格式 (确保 > 后有空格)
+        if not raw_header.startswith("> "):
+            callout_header = raw_header.replace(">", "> ", 1)
+        else:
+            callout_header = raw_header
+
+        # 提取正文 (去除每一行开头的引用符 >)
+        lines = raw_segment.split('\n')[1:]
+        body_lines = [re.sub(r'^>\s?', '', line) for line in lines]
+        processing_text = "\n".join(body_lines).strip()
+
+    elif raw_segment.strip().startswith(">"):
+        # 处理普通引用块
+        is_callout = True
+        callout_header = ">"
+        lines = raw_segment.split('\n')
+        body_lines = [re.sub(r'^>\s?', '', line) for line in lines]
+        processing_text = "\n".join(body_lines).strip()
+
+    # --- Step 2: 内容保护 (加密) ---
+    protector = ContentProtector()
+    masked_text = protector.protect(processing_text)
+    return is_callout, callout_header, protector, masked_text
+
+
+def find_open_segment(content):
+    """
+    返回最后一个闭合标签之后、尚未闭合的 <ai> 内的文本；没有则返回 None。
+    只处理"在笔记末尾输入"的情况：标签后若还有空行分隔的其他内容 (用户在笔记中间输入)，
+    无法确定片段边界，预取的文本也不可能与闭合后的片段一致，直接放弃。
+    """
+    last_end = 0
+    for match in PATTERN.finditer(content):
+        last_end = match.end()
+    start_idx = content.find(START_TAG, last_end)
+    if start_idx == -1:
+        return None
+    tail = content[start_idx + len(START_TAG):].strip()
+    if START_TAG in tail or REGEX_PARAGRAPH_BREAK.search(tail):
+        return None
+    return tail
+
+
+def prefetch_open_segment(agent, file_path, content):
+    # 用户仍在输入的 <ai> 片段：文本稳定后在后台预先完成检索
+    open_segment = find_open_segment(content) if START_TAG in content else None
+    if not open_segment:
+        agent.prefetcher.forget(file_path)
+        return
+    _is_callout, _header, _protector, masked_text = prepare_segment(open_segment)
+    agent.prefetcher.observe(file_path, masked_text)
+
+
 def process_segment(agent, file_path):
     try:
         with open(file_path, "r", encoding="utf-8") as f:
             content = f.read()
 
+        # 低内存模式：含 <ai> 的笔记刚被修改，提前在后台重载模型
+        mtime = os.path.getmtime(file_path)
+        if LAST_MTIMES.get(file_path, mtime) != mtime and START_TAG in content and PRELOAD_ON_EDIT:
+            agent.resources.warm_up()
+        LAST_MTIMES[file_path] = mtime
+
+        # 推测式预取：处理未闭合的 <ai> 标签
+        prefetch_open_segment(agent, file_path, content)
+
         # 快速检查：如果文件里没标签，直接跳过，节省资源
         if START_TAG not in content:
             return
@@ -118,40 +202,10 @@ def process_segment(agent, file_path):
         for match in reversed(matches):
             raw_segment = match.group(1).strip()
 
-            # --- Step 1: 结构识别 (Callout vs 普通文本) ---
-            is_callout = False
-            callout_header = ""
-            processing_text = raw_segment
-
-            header_match = REGEX_CALLOUT_HEADER.match(raw_segment)
-
-            if header_match:
-                is_callout = True
-                raw_header = raw_segment.split('\n')[0].strip()
-                # 规范化 Callout 格式 (确保 > 后有空格)
-                if not raw_header.startswith("> "):
-                    callout_header = raw_header.replace(">", "> ", 1)
-                else:
-                    callout_header = raw_header
-
-                # 提取正文 (去除每一行开头的引用符 >)
-                lines = raw_segment.split('\n')[1:]
-                body_lines = [re.sub(r'^>\s?', '', line) for line in lines]
-                processing_text = "\n".join(body_lines).strip()
+            is_callout, callout_header, protector, masked_text = prepare_segment(raw_segment)
+            if is_callout and callout_header != ">":
                 logging.info(f"  🔹 Callout identified: {callout_header}")
 
-            elif raw_segment.strip().startswith(">"):
-                # 处理普通引用块
-                is_callout = True
-                callout_header = ">"
-                lines = raw_segment.split('\n')
-                body_lines = [re.sub(r'^>\s?', '', line) for line in lines]
-                processing_text = "\n".join(body_lines).strip()
-
-            # --- Step 2: 内容保护 (加密) ---
-            protector = ContentProtector()
-            masked_text = protector.protect(processing_text)
-
             # --- Step 3: Agent 处理 (调用 LLM) ---
             processed_text = agent.generate_note(masked_text)
 
@@ -219,9 +273,14 @@ def main():
     try:
         while True:
             scan_and_process(agent)
+            agent.resources.maybe_unload()
             time.sleep(2)
     except KeyboardInterrupt:
-        logging.info("Watcher stopped.")
+        agent.prefetcher.shutdown()
+        logging.info(
+            f"Watcher stopped. ({agent.gate.summary()}; {agent.prefetcher.summary()}; "
+            f"{agent.resources.summary()})"
+        )
 
 
 if __name__ == "__main__":
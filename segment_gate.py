@@ -0,0 +1,225 @@
+import os
+import re
+import math
+import logging
+
+# --- 门控配置 (可在 .env 中覆盖) ---
+# 关闭后所有片段照常发送给 LLM
+GATE_ENABLED = os.getenv("GATE_ENABLED", "1") != "0"
+# 判定为"闲聊"的置信度达到此值才会跳过 LLM (越高越保守)
+GATE_CONFIDENCE_THRESHOLD = float(os.getenv("GATE_CONFIDENCE_THRESHOLD", "0.85"))
+# 影子模式：只记录判定、从不跳过。默认开启，先用 test_scripts/gate_calibration.py
+# 和运行时的 LLM 一致率校准阈值，再关闭
+GATE_SHADOW_MODE = os.getenv("GATE_SHADOW_MODE", "1") == "1"
+# 与知识库最相近片段的相关度低于此值，才认为向量检索"同意"跳过
+GATE_MAX_CORPUS_SIMILARITY = float(os.getenv("GATE_MAX_CORPUS_SIMILARITY", "0.35"))
+# 闲聊词的总惩罚上限，避免一个 "ok" 压过片段里的全部技术信号
+CHAT_PENALTY_CAP = 2.0
+
+# --- 词法打分权重 (logit)：任何单一信号都只是加分，不再直接判为技术内容 ---
+WEIGHT_BIAS = -1.0
+WEIGHT_TECH_TERM = 1.5
+WEIGHT_MATH_CODE = 1.5
+WEIGHT_ACRONYM = 1.5
+# 仅当提问句里还有闲聊词以外的实词时才计分 ("how are you?" 不算)
+WEIGHT_QUESTION = 2.5
+# 数字按数据信号计分 ("0.05 0.95 1.96" 这类纯数据片段不是闲聊)
+WEIGHT_NUMBER = 0.8
+WEIGHT_CHAT = 0.8
+WEIGHT_CONTENT = 0.3
+# 除去闲聊词与虚词后一个实词都没有 ("你吃饭了吗"、"OK THANKS")
+WEIGHT_NO_CONTENT = -1.0
+
+# --- 词法特征 ---
+# 占位符 (__IMG_0__ / __LINK_1__) 不参与判定
+REGEX_PLACEHOLDER = re.compile(r'__(?:IMG|LINK)_\d+__')
+REGEX_LATIN_WORD = re.compile(r'[A-Za-z][A-Za-z\-]+')
+REGEX_CJK = re.compile(r'[\u3400-\u9fff\uf900-\ufaff]')
+REGEX_NUMBER = re.compile(r'\d+(?:\.\d+)?')
+# 数学 / 代码 / 数据的信号：LaTeX、两侧有操作数的运算符、希腊字母、百分比、函数调用、代码块
+# (单独的 ^ 或 = 不算，"^_^" 是表情而不是公式)
+REGEX_MATH_CODE = re.compile(
+    r'\$[^$]+\$|\\[a-zA-Z]+|[\w)]\s*[=^<>*/+]\s*[\w(\\]|[∑∫σμβαΔ√≈≤≥]|'
+    r'\d+(?:\.\d+)?%|[A-Za-z_]\w*\(.*?\)|```|`[^`]+`'
+)
+# 大写缩写 (CAPM, VaR, HKMA, ESG ...) 与连字符专名 (Black-Scholes, Black-Litterman)；
+# 在去掉闲聊词后的文本上匹配，"OK"、"LOL"、"THANKS" 不算缩写
+REGEX_ACRONYM = re.compile(r'\b[A-Z][A-Za-z]*[A-Z][A-Za-z]*\b|\b[A-Z][a-z]+-[A-Z][a-z]+\b')
+# 提问 / 请求解释的句式
+REGEX_QUESTION = re.compile(
+    r'[?？]|\b(what|why|how|when|which|explain|define|derive|compare|prove|calculate|difference)\b|'
+    r'什么|为什么|如何|怎么|怎样|哪些|吗|呢|解释|说明|推导|区别',
+    re.IGNORECASE
+)
+# 典型闲聊 / 口头禅 / 日常寒暄
+REGEX_CHAT = re.compile(
+    r'\b(hi|hello|hey|thanks|thank you|thx|lol|lmao|omg|haha+|ok|okay|bye|good (morning|night|afternoon)|'
+    r'how are you|see you|asdf|hmm+|yeah|yep|cool|nice)\b|哈哈+|你好|谢谢|好的|嗯+|再见|吃饭|吃了|在吗|干嘛|晚安|早安',
+    re.IGNORECASE
+)
+
+# 判断"实词"时忽略的英文虚词 / 代词 / 疑问词
+FILLER_WORDS = {
+    "the", "is", "are", "was", "were", "be", "am", "do", "does", "did", "of", "and", "or", "to", "in",
+    "on", "for", "an", "it", "its", "this", "that", "with", "as", "by", "at", "from", "so", "now",
+    "you", "your", "we", "our", "they", "he", "she", "me", "my", "there", "here", "then", "just",
+    "all", "everyone", "guys", "later", "again", "too", "very", "really", "what", "why", "how",
+    "when", "which", "who", "where", "can", "could", "would", "will", "not", "no", "yes", "please",
+}
+# 判断"实词"时忽略的中文虚字 / 代词
+CJK_FILLER = set("你我他她它们的了吗呢吧啊呀哦嘛么是那这就也都很在有和还又再个")
+
+TECH_TERMS = {
+    "alpha", "arbitrage", "asset", "beta", "bond", "capital", "coefficient", "correlation",
+    "covariance", "derivative", "distribution", "duration", "equity", "estimator", "expected",
+    "factor", "futures", "gradient", "hedge", "interest", "liquidity", "matrix", "model",
+    "option", "portfolio", "price", "pricing", "probability", "regression", "return", "risk",
+    "sharpe", "stochastic", "swap", "theorem", "variance", "volatility", "yield", "algorithm",
+    "blockchain", "classification", "clustering", "dataset", "optimization", "regulation",
+    "python", "function", "lemma",
+    "资产", "风险", "收益", "模型", "回归", "波动", "定价", "期权", "组合", "监管", "算法", "数据",
+}
+
+
+def _sigmoid(x):
+    return 1.0 / (1.0 + math.exp(-x))
+
+
+class SegmentGate:
+    """
+    本地门控：在检索和生成之前，用廉价的词法特征 + 与知识库的向量相似度
+    判断片段是否为闲聊/无技术内容。高置信度的闲聊直接原样返回，不消耗 API 配额。
+
+    同时记录门控判定与 LLM 自身 SKIP_PROCESSING 判定的一致率。
+    """
+
+    def __init__(self, vector_db=None, threshold=GATE_CONFIDENCE_THRESHOLD,
+                 enabled=GATE_ENABLED, shadow=GATE_SHADOW_MODE):
+        self.vector_db = vector_db
+        self.threshold = threshold
+        self.enabled = enabled
+        self.shadow = shadow
+        self.stats = {"checked": 0, "skipped": 0, "compared": 0, "agreed": 0}
+
+    def lexical_features(self, text):
+        """提取词法特征 (计数)；闲聊词先从文本中去掉，再统计缩写与实词"""
+        words = REGEX_LATIN_WORD.findall(text)
+        cjk = REGEX_CJK.findall(text)
+        numbers = REGEX_NUMBER.findall(text)
+        lowered = {w.lower() for w in words}
+        cjk_text = "".join(cjk)
+
+        # 去掉闲聊词之后剩下的部分才参与缩写 / 实词判断
+        stripped = REGEX_CHAT.sub(" ", text)
+        content_words = [w for w in REGEX_LATIN_WORD.findall(stripped) if w.lower() not in FILLER_WORDS]
+        content_cjk = [c for c in REGEX_CJK.findall(REGEX_QUESTION.sub(" ", stripped)) if c not in CJK_FILLER]
+        n_content = len(content_words) + len(content_cjk) // 2 + len(numbers)
+
+        return {
+            "n_tokens": len(words) + len(cjk) + len(numbers),
+            "number_hits": len(numbers),
+            "tech_hits": len(lowered & TECH_TERMS) + sum(1 for t in TECH_TERMS if len(t) == 2 and t in cjk_text),
+            "math_hits": len(REGEX_MATH_CODE.findall(text)),
+            "acronym_hits": len(REGEX_ACRONYM.findall(stripped)),
+            "question": bool(REGEX_QUESTION.search(text)) and n_content > 0,
+            "chat_hits": len(REGEX_CHAT.findall(text)),
+            "content_words": n_content,
+            "long_words": sum(1 for w in words if len(w) >= 8),
+        }
+
+    def lexical_logit(self, features):
+        """词法打分 (logit)：>0 倾向技术内容，<0 倾向闲聊"""
+        if features["n_tokens"] == 0:
+            return -4.0
+
+        logit = WEIGHT_BIAS
+        logit += WEIGHT_TECH_TERM * min(features["tech_hits"], 2)
+        logit += WEIGHT_MATH_CODE * min(features["math_hits"], 2)
+        logit += WEIGHT_ACRONYM * min(features["acronym_hits"], 2)
+        logit += WEIGHT_QUESTION * features["question"]
+        logit += WEIGHT_NUMBER * min(features["number_hits"], 3)
+        logit += 0.6 * min(features["long_words"], 3)
+        logit += 0.4 * min(features["n_tokens"] / 10.0, 3.0)
+        if features["content_words"]:
+            logit += WEIGHT_CONTENT * min(features["content_words"], 4)
+        else:
+            logit += WEIGHT_NO_CONTENT
+        logit -= min(WEIGHT_CHAT * features["chat_hits"], CHAT_PENALTY_CAP)
+        return logit
+
+    def lexical_verdict(self, text):
+        """仅凭词法特征的判定 (is_technical, confidence)，不做向量检索"""
+        features = self.lexical_features(REGEX_PLACEHOLDER.sub(" ", text))
+        p_technical = _sigmoid(self.lexical_logit(features))
+        return p_technical >= 0.5, max(p_technical, 1 - p_technical)
+
+    def corpus_similarity(self, text):
+        """与本地知识库最相近片段的相关度 (0~1)；库为空或检索失败时返回 None"""
+        if self.vector_db is None:
+            return None
+        try:
+            if self.vector_db._collection.count() == 0:
+                return None
+            results = self.vector_db.similarity_search_with_relevance_scores(text, k=1)
+            return results[0][1] if results else 0.0
+        except Exception as e:
+            logging.warning(f"⚠️ Gate similarity check failed: {e}")
+            return None
+
+    def classify(self, text):
+        """
+        返回 (is_technical, confidence)。
+        只有词法高置信度判为闲聊时才做向量检索，且必须与知识库的相似度也足够低，
+        才维持"闲聊"判定；库为空或检索失败时无法确认，置信度降为 0.5 (不跳过)。
+        """
+        is_technical, confidence = self.lexical_verdict(text)
+        if is_technical or confidence < self.threshold:
+            return is_technical, confidence
+
+        similarity = self.corpus_similarity(REGEX_PLACEHOLDER.sub(" ", text))
+        if similarity is None:
+            return False, 0.5
+        if similarity >= GATE_MAX_CORPUS_SIMILARITY:
+            return True, similarity
+        return False, confidence
+
+    def would_skip(self, is_technical, confidence):
+        """给定判定结果，是否应跳过 LLM"""
+        return not is_technical and confidence >= self.threshold and not self.shadow
+
+    def should_skip(self, text, classification=None):
+        """
+        门控入口：返回 (skip, verdict)。verdict 为 is_technical，
+        留给 record_llm_decision 计算一致率。
+        classification 为预取线程提前算好的 classify 结果，传入时不再重复检索。
+        """
+        if not self.enabled:
+            return False, None
+
+        is_technical, confidence = classification or self.classify(text)
+        self.stats["checked"] += 1
+        skip = self.would_skip(is_technical, confidence)
+        if skip:
+            self.stats["skipped"] += 1
+        return skip, is_technical
+
+    def record_llm_decision(self, verdict, llm_skipped):
+        """记录 LLM 的 SKIP_PROCESSING 判定，与门控判定比对"""
+        if verdict is None:
+            return
+        self.stats["compared"] += 1
+        if verdict == (not llm_skipped):
+            self.stats["agreed"] += 1
+
+    def agreement_rate(self):
+        if self.stats["compared"] == 0:
+            return None
+        return self.stats["agreed"] / self.stats["compared"]
+
+    def summary(self):
+        rate = self.agreement_rate()
+        rate_str = f"{rate:.0%}" if rate is not None else "n/a"
+        return (
+            f"gate skipped {self.stats['skipped']}/{self.stats['checked']}, "
+            f"LLM agreement {rate_str} ({self.stats['agreed']}/{self.stats['compared']})"
+        )
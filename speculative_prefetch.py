@@ -0,0 +1,136 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# --- 预取配置 (可在 .env 中覆盖) ---
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "1") != "0"
+# 未闭合 <ai> 内的文本保持不变多久后开始预取 (秒)
+PREFETCH_STABLE_SECONDS = float(os.getenv("PREFETCH_STABLE_SECONDS", "3"))
+# 缓存结果的有效期 (秒)，防止知识库重建后命中过期上下文
+PREFETCH_TTL_SECONDS = 600
+# 最多缓存多少条预取结果
+PREFETCH_MAX_ENTRIES = 32
+# 超长的未闭合片段不做预取 (多半是标签后面跟着整篇笔记)
+PREFETCH_MAX_CHARS = 4000
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class SpeculativePrefetcher:
+    """
+    推测式预取：用户还在 <ai> 标签内打字时，一旦文本稳定一段时间，
+    就在后台线程里完成门控判定 + Embedding + 检索 + 上下文组装，并按文本哈希缓存。
+    标签闭合后 generate_note 命中缓存，关键路径上只剩 LLM 调用。
+    """
+
+    def __init__(self, compute, enabled=PREFETCH_ENABLED, stable_seconds=PREFETCH_STABLE_SECONDS):
+        # compute(text) -> 任意结果，即 Agent 的预取任务 (门控判定 + 上下文组装)
+        self.compute = compute
+        self.enabled = enabled
+        self.stable_seconds = stable_seconds
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        self.lock = threading.Lock()
+        self.pending = {}  # key -> (text, first_seen, submitted)
+        self.cache = {}  # hash -> {"future", "submitted_at"}
+        self.stats = {"submitted": 0, "hits": 0, "misses": 0, "saved_ms": 0.0}
+
+    def observe(self, key, text):
+        """
+        守护进程每轮扫描时调用：key 通常是文件路径，text 是未闭合标签内已处理好的文本。
+        文本连续 stable_seconds 不变才提交后台任务，避免每敲一个字就检索一次。
+        """
+        if not self.enabled or not text or len(text) > PREFETCH_MAX_CHARS:
+            return
+
+        now = time.monotonic()
+        previous = self.pending.get(key)
+        if previous is None or previous[0] != text:
+            self.pending[key] = (text, now, False)
+            return
+
+        _text, first_seen, submitted = previous
+        if submitted or now - first_seen < self.stable_seconds:
+            return
+
+        self.pending[key] = (text, first_seen, True)
+        self._submit(text)
+
+    def forget(self, key):
+        """文件中已没有未闭合标签时清理跟踪状态"""
+        self.pending.pop(key, None)
+
+    def _submit(self, text):
+        digest = text_hash(text)
+        with self.lock:
+            if digest in self.cache:
+                return
+            self._evict()
+            self.cache[digest] = {
+                "future": self.executor.submit(self._run, text),
+                "submitted_at": time.monotonic(),
+            }
+            self.stats["submitted"] += 1
+        logging.info(f"  🔮 Prefetching context for open <ai> tag ({len(text)} chars)")
+
+    def _run(self, text):
+        start = time.perf_counter()
+        result = self.compute(text)
+        return result, (time.perf_counter() - start) * 1000
+
+    def _evict(self):
+        # 调用方持有 lock：先清理过期项，再按提交时间淘汰最旧的
+        now = time.monotonic()
+        for digest in [d for d, e in self.cache.items() if now - e["submitted_at"] > PREFETCH_TTL_SECONDS]:
+            del self.cache[digest]
+        while len(self.cache) >= PREFETCH_MAX_ENTRIES:
+            oldest = min(self.cache, key=lambda d: self.cache[d]["submitted_at"])
+            del self.cache[oldest]
+
+    def take(self, text):
+        """
+        取出预取结果：返回 (result, saved_ms)，未命中返回 None。
+        若后台任务仍在运行则等待它完成 (仍能节省已经跑过的那部分时间)。
+        """
+        if not self.enabled:
+            return None
+
+        with self.lock:
+            entry = self.cache.pop(text_hash(text), None)
+
+        expired = entry and time.monotonic() - entry["submitted_at"] > PREFETCH_TTL_SECONDS
+        if not entry or expired:
+            self.stats["misses"] += 1
+            return None
+
+        wait_start = time.perf_counter()
+        try:
+            result, cost_ms = entry["future"].result()
+        except Exception as e:
+            logging.warning(f"⚠️ Prefetch failed, falling back to inline retrieval: {e}")
+            self.stats["misses"] += 1
+            return None
+
+        saved_ms = max(0.0, cost_ms - (time.perf_counter() - wait_start) * 1000)
+        self.stats["hits"] += 1
+        self.stats["saved_ms"] += saved_ms
+        return result, saved_ms
+
+    def hit_rate(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else None
+
+    def summary(self):
+        rate = self.hit_rate()
+        rate_str = f"{rate:.0%}" if rate is not None else "n/a"
+        return (
+            f"prefetch hit rate {rate_str} ({self.stats['hits']}/{self.stats['hits'] + self.stats['misses']}, "
+            f"{self.stats['submitted']} submitted), saved {self.stats['saved_ms']:.0f}ms total"
+        )
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
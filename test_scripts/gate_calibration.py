@@ -0,0 +1,110 @@
+"""
+门控校准：在带标签的样本上评估 SegmentGate，给出每个阈值下的误跳过 (技术内容被跳过) 与闲聊拦截率。
+误跳过必须为 0 才能关闭 GATE_SHADOW_MODE。
+
+用法:
+    python gate_calibration.py          # 仅词法阶段：统计词法上的跳过候选 (实际跳过还需向量相似度同意)
+    python gate_calibration.py --db     # 加载本地 ChromaDB，评估完整判定 (词法 + 向量相似度)
+"""
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from segment_gate import SegmentGate
+
+# --- 配置 (必须与 indexer_pro.py 一致) ---
+DB_DIR = "../chroma_db"
+COLLECTION_NAME = "fintech_knowledge"
+MODEL_NAME = "BAAI/bge-m3"
+
+THRESHOLDS = [0.6, 0.7, 0.8, 0.85, 0.9, 0.95]
+
+# (文本, 是否为技术内容)
+SAMPLES = [
+    ("ok thanks, now explain Ito's lemma", True),
+    ("Thanks! What is a martingale?", True),
+    ("ok what is VaR", True),
+    ("hmm ok so why is theta negative for long calls", True),
+    ("hello world in python: print('hi')", True),
+    ("谢谢老师讲解 Black-Scholes", True),
+    ("好的，那什么是凸性？", True),
+    ("The professor derived the put-call parity from a no-arbitrage argument.", True),
+    ("Duration measures bond price sensitivity to interest rate changes.", True),
+    ("mean reversion in pairs trading, spread half-life", True),
+    ("今天讲了资产定价模型 CAPM", True),
+    ("GARCH(1,1) captures volatility clustering", True),
+    ("0.05 0.95 1.96", True),
+    ("2019 12.4% 2020 -3.1% 2021 8.7%", True),
+    ("| year | return |\n| --- | --- |\n| 2020 | 0.12 |", True),
+    ("r = 0.05, T = 2", True),
+    ("haha ok thanks", False),
+    ("hi there, see you later lol", False),
+    ("哈哈 好的 谢谢", False),
+    ("hmm okay bye", False),
+    ("thanks!", False),
+    ("good morning everyone", False),
+    ("asdf asdf", False),
+    ("__IMG_0__", False),
+    ("hello, how are you?", False),
+    ("OK THANKS", False),
+    ("LOL", False),
+    ("你吃饭了吗", False),
+    ("在吗", False),
+    ("lol ^_^", False),
+    ("hey guys, see you tomorrow", False),
+    ("good night everyone, thanks!", False),
+    ("晚安 明天见", False),
+]
+
+
+def load_vector_db():
+    from langchain_huggingface import HuggingFaceEmbeddings
+    from langchain_chroma import Chroma
+
+    embeddings = HuggingFaceEmbeddings(model_name=MODEL_NAME, model_kwargs={'device': 'cpu'})
+    return Chroma(persist_directory=DB_DIR, embedding_function=embeddings, collection_name=COLLECTION_NAME)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate the local segment gate on labelled samples")
+    parser.add_argument("--db", action="store_true", help="Include corpus similarity (loads bge-m3 + ChromaDB)")
+    args = parser.parse_args()
+
+    vector_db = load_vector_db() if args.db else None
+    if vector_db is None:
+        print("ℹ️ Lexical stage only: counts skip candidates before the corpus-similarity check\n")
+    chats = sum(1 for _, label in SAMPLES if not label)
+
+    print(f"{'threshold':>9} | {'false skips':>11} | {'chat caught':>11}")
+    print("-" * 39)
+    safe = []
+    for threshold in THRESHOLDS:
+        gate = SegmentGate(vector_db, threshold=threshold, shadow=False)
+        false_skips, caught = [], 0
+        for text, is_technical in SAMPLES:
+            if vector_db is None:
+                is_technical_guess, confidence = gate.lexical_verdict(text)
+                skip = not is_technical_guess and confidence >= threshold
+            else:
+                skip, _verdict = gate.should_skip(text)
+            if skip and is_technical:
+                false_skips.append(text)
+            elif skip:
+                caught += 1
+        print(f"{threshold:>9.2f} | {len(false_skips):>11} | {caught:>5}/{chats:<5}")
+        for text in false_skips:
+            print(f"          ❌ {text}")
+        if not false_skips:
+            safe.append((caught, threshold))
+
+    if safe:
+        best = max(safe)[1]
+        print(f"\n✅ Suggested GATE_CONFIDENCE_THRESHOLD={best} (no technical segment skipped)")
+    else:
+        print("\n⚠️ Every threshold skips technical content; keep GATE_SHADOW_MODE=1")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""
+本地 Gemini 替身服务器：模拟 generateContent / streamGenerateContent 接口，
+用于在不消耗真实配额的情况下对守护进程做压测与长时间浸泡测试。
+
+用法:
+    python gemini_standin_server.py --port 8765 --latency lognormal:800,0.5 --error-429 0.05
+    # 然后在 .env 中设置 GEMINI_BASE_URL=http://127.0.0.1:8765
+"""
+import re
+import json
+import math
+import time
+import random
+import hashlib
+import logging
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 匹配 /v1beta/models/<model>:generateContent 与 :streamGenerateContent
+REGEX_ROUTE = re.compile(r'^/(?P<version>[^/]+)/models/(?P<model>[^:/]+):(?P<method>generateContent|streamGenerateContent)')
+# Agent 的 Prompt 以 [USER INPUT] 结尾，替身只回显这一段
+USER_INPUT_MARKER = "[USER INPUT]"
+# 替身回复中的固定标记，浸泡测试据此判断笔记是否被"处理"过
+REPLY_MARKER = "STANDIN_REPLY"
+
+ERRORS = {
+    429: {"code": 429, "message": "Resource has been exhausted (stand-in injected).", "status": "RESOURCE_EXHAUSTED"},
+    500: {"code": 500, "message": "Internal error (stand-in injected).", "status": "INTERNAL"},
+}
+
+
+def parse_latency(spec):
+    """
+    解析延迟分布，返回一个无参函数 (每次调用采样一次，单位秒)：
+      fixed:200 | uniform:100,800 | normal:400,100 | lognormal:400,0.5 (中位数 ms, sigma)
+    """
+    kind, _, raw = spec.partition(":")
+    values = [float(v) for v in raw.split(",") if v]
+    if kind == "fixed":
+        return lambda: values[0] / 1000
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1]) / 1000
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(values[0], values[1])) / 1000
+    if kind == "lognormal":
+        mu = math.log(values[0])
+        return lambda: random.lognormvariate(mu, values[1]) / 1000
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class StandInConfig:
+    def __init__(self, latency="lognormal:800,0.5", error_429=0.0, error_500=0.0,
+                 skip_rate=0.0, skip_pattern=None, stream_chunks=4):
+        self.latency_spec = latency
+        self.sample_latency = parse_latency(latency)
+        self.error_429 = error_429
+        self.error_500 = error_500
+        self.skip_rate = skip_rate
+        self.skip_pattern = re.compile(skip_pattern) if skip_pattern else None
+        self.stream_chunks = max(1, stream_chunks)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "streams": 0, "429": 0, "500": 0, "skips": 0}
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+
+def extract_prompt(body):
+    """把请求体中 systemInstruction 与 contents 的所有文本拼起来"""
+    texts = []
+    system = body.get("systemInstruction") or body.get("system_instruction") or {}
+    for part in system.get("parts", []):
+        texts.append(part.get("text", ""))
+    for content in body.get("contents", []):
+        for part in content.get("parts", []):
+            texts.append(part.get("text", ""))
+    return "\n".join(texts)
+
+
+def build_reply(prompt, model, config):
+    """生成确定性的回复：回显用户输入 (保留 __IMG_n__ / __LINK_n__ 占位符) + 术语分析"""
+    user_input = prompt.rsplit(USER_INPUT_MARKER, 1)[-1].strip()
+
+    if (config.skip_pattern and config.skip_pattern.search(user_input)) or random.random() < config.skip_rate:
+        config.count("skips")
+        return "SKIP_PROCESSING"
+
+    digest = hashlib.sha1(user_input.encode("utf-8")).hexdigest()[:8]
+    return (
+        f"{user_input}\n\n"
+        f"{REPLY_MARKER} ({model}, {digest})\n\n"
+        f"### 🏆Key Term Analysis\n"
+        f"* **Stand-in Term**\n"
+        f"    * **Origin**: Synthetic reply from the local Gemini stand-in.\n"
+        f"    * **Application**: Load and soak testing without API quota.\n"
+        f"    * **Expansion**: N/A\n"
+    )
+
+
+def response_payload(text, model, prompt, final=True):
+    payload = {
+        "candidates": [{
+            "content": {"parts": [{"text": text}], "role": "model"},
+            "index": 0,
+        }],
+        "modelVersion": model,
+    }
+    if final:
+        payload["candidates"][0]["finishReason"] = "STOP"
+        prompt_tokens = len(prompt) // 4
+        reply_tokens = len(text) // 4
+        payload["usageMetadata"] = {
+            "promptTokenCount": prompt_tokens,
+            "candidatesTokenCount": reply_tokens,
+            "totalTokenCount": prompt_tokens + reply_tokens,
+        }
+    return payload
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    config = None  # 由 start_server 注入
+
+    def log_message(self, format, *args):
+        logging.debug("stand-in: " + format % args)
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        route = REGEX_ROUTE.match(self.path)
+        if not route:
+            self._send_json(404, {"error": {"code": 404, "message": f"Unknown path {self.path}", "status": "NOT_FOUND"}})
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": {"code": 400, "message": "Invalid JSON", "status": "INVALID_ARGUMENT"}})
+            return
+
+        config = self.config
+        config.count("requests")
+        model = route.group("model")
+        latency = config.sample_latency()
+
+        # 错误注入：先等一小段时间，模拟服务端处理后才报错
+        roll = random.random()
+        for status, rate in ((429, config.error_429), (500, config.error_500)):
+            if roll < rate:
+                config.count(str(status))
+                time.sleep(latency * 0.1)
+                self._send_json(status, {"error": ERRORS[status]})
+                return
+            roll -= rate
+
+        prompt = extract_prompt(body)
+        reply = build_reply(prompt, model, config)
+
+        if route.group("method") == "generateContent":
+            time.sleep(latency)
+            self._send_json(200, response_payload(reply, model, prompt))
+        else:
+            self._stream(reply, model, prompt, latency)
+
+    def _stream(self, reply, model, prompt, latency):
+        # SSE 流式响应：首包占总延迟的 40%，其余平均分给后续分片
+        self.config.count("streams")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        n = self.config.stream_chunks
+        size = max(1, -(-len(reply) // n))
+        chunks = [reply[i:i + size] for i in range(0, len(reply), size)] or [""]
+        time.sleep(latency * 0.4)
+        for i, chunk in enumerate(chunks):
+            if i:
+                time.sleep(latency * 0.6 / max(1, len(chunks) - 1))
+            payload = response_payload(chunk, model, prompt, final=(i == len(chunks) - 1))
+            self.wfile.write(f"data: {json.dumps(payload)}\r\n\r\n".encode("utf-8"))
+            self.wfile.flush()
+
+
+def start_server(config, host="127.0.0.1", port=8765):
+    """在后台线程启动替身服务器，返回 (server, base_url)"""
+    handler = type("ConfiguredStandInHandler", (StandInHandler,), {"config": config})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="gemini-standin", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Gemini stand-in server for load/soak testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", default="lognormal:800,0.5",
+                        help="fixed:MS | uniform:LO,HI | normal:MEAN,STD | lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--error-429", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--error-500", type=float, default=0.0, help="Fraction of requests answered with 500")
+    parser.add_argument("--skip-rate", type=float, default=0.0, help="Fraction of replies that are SKIP_PROCESSING")
+    parser.add_argument("--skip-pattern", default=None, help="Regex on the user input that forces SKIP_PROCESSING")
+    parser.add_argument("--stream-chunks", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    random.seed(args.seed)
+    config = StandInConfig(args.latency, args.error_429, args.error_500,
+                           args.skip_rate, args.skip_pattern, args.stream_chunks)
+    server, base_url = start_server(config, args.host, args.port)
+    print(f"🧪 Gemini stand-in listening on {base_url} (latency {args.latency})")
+    print(f"   Set GEMINI_BASE_URL={base_url} to point the agent here.")
+
+    try:
+        while True:
+            time.sleep(30)
+            logging.info(f"stand-in stats: {config.stats}")
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(f"Stopped. Stats: {config.stats}")
+
+
+if __name__ == "__main__":
+    main()
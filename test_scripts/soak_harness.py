@@ -0,0 +1,413 @@
+"""
+浸泡测试 (Soak Test)：用合成的 Obsidian 笔记库，驱动 lecture_agent_daemon 连续运行数小时，
+LLM 由本地替身服务器 (gemini_standin_server.py) 提供，不消耗真实配额。
+
+报告内容：吞吐量、端到端尾延迟、内存增长，以及写回笔记的正确性。
+
+用法:
+    python test_scripts/soak_harness.py --hours 4 --rate 6 --latency lognormal:800,0.5 --error-429 0.05
+    python test_scripts/soak_harness.py --hours 1 --typing 10     # 模拟逐步输入，覆盖推测式预取
+"""
+import os
+import sys
+import re
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(SCRIPT_DIR)
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, SCRIPT_DIR)
+
+from gemini_standin_server import StandInConfig, start_server, REPLY_MARKER
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# --- 合成笔记素材 ---
+TECH_SENTENCES = [
+    "The Black-Scholes model assumes constant volatility and log-normal returns for the underlying asset.",
+    "CAPM relates expected return to systematic risk through beta, with the market portfolio as benchmark.",
+    "Value at Risk (VaR) at 99% estimates the loss threshold exceeded only 1% of the time.",
+    "Markowitz mean-variance optimization often yields corner solutions with extreme portfolio weights.",
+    "The Sharpe ratio $S = (R_p - R_f) / \\sigma_p$ measures excess return per unit of volatility.",
+    "逻辑回归模型用于信用风险评分，输出违约概率。",
+    "Basel III introduces the liquidity coverage ratio to ensure banks hold enough high-quality liquid assets.",
+]
+CHAT_SENTENCES = [
+    "haha ok thanks",
+    "hi there, see you later lol",
+    "哈哈 好的 谢谢",
+    "hmm okay bye",
+]
+# 替身服务器据此对闲聊片段回复 SKIP_PROCESSING (只看句子本身，与片段 ID 无关)
+CHAT_PATTERN = r"^(?:" + "|".join(re.escape(s) for s in CHAT_SENTENCES) + r")\b"
+LINK_TARGETS = ["Black-Scholes Model", "CAPM", "Lecture 03 Risk"]
+FILLER_LINES = 5
+
+
+def rss_mb():
+    """
+    当前进程常驻内存 (MB)。没有 psutil 时退化为 ru_maxrss，那是历史峰值而不是当前值，
+    只能单调上升，报告中会标注为 peak-only 且不计算增长斜率。
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 1024 / 1024
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def slope_per_hour(samples):
+    """最小二乘拟合内存增长斜率 (MB/h)"""
+    if len(samples) < 2:
+        return 0.0
+    n = len(samples)
+    mean_t = sum(t for t, _ in samples) / n
+    mean_m = sum(m for _, m in samples) / n
+    var_t = sum((t - mean_t) ** 2 for t, _ in samples)
+    if var_t == 0:
+        return 0.0
+    cov = sum((t - mean_t) * (m - mean_m) for t, m in samples)
+    return cov / var_t * 3600
+
+
+class SyntheticVault:
+    """
+    合成笔记库：持续向随机笔记追加 <ai> 片段，并跟踪每个片段的处理结果。
+    每个片段带唯一 ID，写成双链 [[soak-xxxxxx]]：守护进程会把它替换为 __LINK_n__ 占位符，
+    门控判定时忽略，不会让闲聊片段因为 ID 被判为技术内容。
+
+    typing > 0 时模拟逐步输入：先写入开标签与正文，typing 秒后再补上闭标签，
+    期间守护进程能看到未闭合的标签并触发推测式预取。
+    """
+
+    def __init__(self, path, n_notes, chat_ratio, link_ratio, typing=0.0):
+        self.path = path
+        self.chat_ratio = chat_ratio
+        self.link_ratio = link_ratio
+        self.typing = typing
+        self.segments = {}
+        self.notes = []
+        self.open_notes = set()
+        self.counter = 0
+
+        os.makedirs(path, exist_ok=True)
+        for i in range(n_notes):
+            note = os.path.join(path, f"Soak Note {i:03d}.md")
+            filler = "\n".join(self.filler(i, j) for j in range(FILLER_LINES))
+            with open(note, "w", encoding="utf-8") as f:
+                f.write(f"# Soak Note {i:03d}\n\n{filler}\n")
+            self.notes.append(note)
+
+    @staticmethod
+    def filler(note_idx, line_idx):
+        return f"Filler line {line_idx} of note {note_idx:03d} must survive untouched."
+
+    def add_segment(self):
+        # 逐步输入时，未闭合的标签必须留在笔记末尾：同一笔记同时只输入一个片段
+        notes = [n for n in self.notes if n not in self.open_notes]
+        if not notes:
+            return
+
+        self.counter += 1
+        kind = "CHAT" if random.random() < self.chat_ratio else "TECH"
+        seg_id = f"soak-{self.counter:06d}"
+        sentence = random.choice(CHAT_SENTENCES if kind == "CHAT" else TECH_SENTENCES)
+        text = f"{sentence} [[{seg_id}]]"
+        if kind == "TECH" and random.random() < self.link_ratio:
+            text += f" See [[{random.choice(LINK_TARGETS)}]]."
+
+        note = random.choice(notes)
+        block = f"<ai>\n{text}\n</ai>"
+        now = time.monotonic()
+        seg = {
+            "kind": kind, "note": note, "text": text, "block": block,
+            "close_at": now + self.typing, "closed_at": None, "done_at": None,
+        }
+        self.segments[seg_id] = seg
+
+        if self.typing > 0:
+            with open(note, "a", encoding="utf-8") as f:
+                f.write(f"\n<ai>\n{text}\n")
+            self.open_notes.add(note)
+        else:
+            with open(note, "a", encoding="utf-8") as f:
+                f.write(f"\n{block}\n")
+            seg["closed_at"] = now
+
+    def close_due(self):
+        """为输入时间已到的片段补上闭标签 (逐步输入模式)"""
+        now = time.monotonic()
+        for seg in self.segments.values():
+            if seg["closed_at"] is None and now >= seg["close_at"]:
+                with open(seg["note"], "a", encoding="utf-8") as f:
+                    f.write("</ai>\n")
+                seg["closed_at"] = now
+                self.open_notes.discard(seg["note"])
+
+    def _read_notes(self):
+        contents = {}
+        for note in self.notes:
+            with open(note, "r", encoding="utf-8") as f:
+                contents[note] = f.read()
+        return contents
+
+    def poll(self):
+        """
+        标签已被守护进程消费的片段记为完成，返回本轮完成的端到端延迟 (秒)。
+        延迟从闭标签写入时算起 (逐步输入期间的等待不计入)。
+        """
+        contents = self._read_notes()
+        now = time.monotonic()
+        latencies = []
+        for seg in self.segments.values():
+            if seg["closed_at"] is None or seg["done_at"] is not None:
+                continue
+            if seg["block"] not in contents[seg["note"]]:
+                seg["done_at"] = now
+                latencies.append(now - seg["closed_at"])
+        return latencies
+
+    def pending(self):
+        return sum(1 for s in self.segments.values() if s["done_at"] is None)
+
+    def verify(self):
+        """
+        核对写回结果：
+          enriched = 替身回复已写回 (原文 + STANDIN_REPLY)
+          raw      = 原文保留、无回复 (闲聊被跳过，或 LLM 出错降级)
+          pending  = <ai> 标签仍在 (含尚未闭合的片段)
+          lost     = 原文不见了 (数据损坏)
+        """
+        contents = self._read_notes()
+        outcomes = {}
+        for seg in self.segments.values():
+            content = contents[seg["note"]]
+            if seg["closed_at"] is None or seg["block"] in content:
+                outcome = "pending"
+            elif f"{seg['text']}\n\n{REPLY_MARKER}" in content:
+                outcome = "enriched"
+            elif seg["text"] in content:
+                outcome = "raw"
+            else:
+                outcome = "lost"
+            key = f"{seg['kind']}:{outcome}"
+            outcomes[key] = outcomes.get(key, 0) + 1
+
+        filler_missing = 0
+        for i, note in enumerate(self.notes):
+            filler_missing += sum(1 for j in range(FILLER_LINES) if self.filler(i, j) not in contents[note])
+
+        expected = outcomes.get("TECH:enriched", 0) + outcomes.get("CHAT:raw", 0)
+        return {
+            "outcomes": outcomes,
+            "correct": expected,
+            "total": len(self.segments),
+            "accuracy": expected / len(self.segments) if self.segments else None,
+            "filler_lines_missing": filler_missing,
+        }
+
+
+class TimedChain:
+    """包装 agent.chain：只统计 chain.invoke (Prompt 渲染 + LLM 请求 + 解析) 的耗时"""
+
+    def __init__(self, chain, samples):
+        self.chain = chain
+        self.samples = samples
+
+    def invoke(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.chain.invoke(*args, **kwargs)
+        finally:
+            self.samples.append((time.perf_counter() - start) * 1000)
+
+
+def build_report(started, vault, e2e, note_calls, llm_calls, memory, extra):
+    elapsed = time.monotonic() - started
+    done = len(e2e)
+    return {
+        "elapsed_s": round(elapsed, 1),
+        "segments_written": len(vault.segments),
+        "segments_processed": done,
+        "segments_pending": vault.pending(),
+        "throughput_per_min": round(done / elapsed * 60, 2) if elapsed else 0.0,
+        "e2e_latency_s": {q: round(percentile(e2e, q), 2) for q in (50, 95, 99, 100)},
+        "generate_note_ms": {q: round(percentile(note_calls, q), 1) for q in (50, 95, 99, 100)},
+        "llm_calls": len(llm_calls),
+        "llm_call_ms": {q: round(percentile(llm_calls, q), 1) for q in (50, 95, 99, 100)},
+        "memory_mb": {
+            "source": "rss" if psutil is not None else "ru_maxrss (peak-only, install psutil)",
+            "start": round(memory[0][1], 1) if memory else None,
+            "peak": round(max(m for _, m in memory), 1) if memory else None,
+            "end": round(memory[-1][1], 1) if memory else None,
+            # 峰值序列的斜率不是内存增长，没有 psutil 时不报告
+            "growth_mb_per_hour": round(slope_per_hour(memory), 2) if psutil is not None else None,
+        },
+        **extra,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak test lecture_agent_daemon against the local Gemini stand-in")
+    parser.add_argument("--hours", type=float, default=1.0, help="Duration of the write phase")
+    parser.add_argument("--rate", type=float, default=6.0, help="New <ai> segments per minute (Poisson)")
+    parser.add_argument("--notes", type=int, default=20, help="Number of notes in the synthetic vault")
+    parser.add_argument("--chat-ratio", type=float, default=0.2)
+    parser.add_argument("--link-ratio", type=float, default=0.3)
+    parser.add_argument("--typing", type=float, default=0.0,
+                        help="Seconds between writing <ai> + text and the closing tag (0 = write whole blocks); "
+                             "must exceed PREFETCH_STABLE_SECONDS plus one scan for prefetch to fire")
+    parser.add_argument("--poll", type=float, default=2.0, help="Daemon scan interval (seconds)")
+    parser.add_argument("--drain", type=float, default=300.0, help="Max seconds to wait for pending segments")
+    parser.add_argument("--report-every", type=float, default=300.0)
+    parser.add_argument("--vault", default=None, help="Vault directory (default: temp dir, deleted afterwards)")
+    parser.add_argument("--report-json", default=None, help="Write the final report to this file")
+    parser.add_argument("--base-url", default=None, help="Use an external stand-in instead of starting one")
+    parser.add_argument("--latency", default="lognormal:800,0.5")
+    parser.add_argument("--error-429", type=float, default=0.0)
+    parser.add_argument("--error-500", type=float, default=0.0)
+    parser.add_argument("--skip-rate", type=float, default=0.0)
+    parser.add_argument("--low-memory", action="store_true", help="Enable LOW_MEMORY_MODE in the agent")
+    parser.add_argument("--idle-unload", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if psutil is None:
+        print("⚠️ psutil not installed: memory is reported as peak RSS only, without a growth rate")
+
+    # 1. 启动替身服务器 (闲聊片段强制回复 SKIP_PROCESSING)
+    standin = None
+    base_url = args.base_url
+    if not base_url:
+        standin = StandInConfig(args.latency, args.error_429, args.error_500,
+                                args.skip_rate, skip_pattern=CHAT_PATTERN)
+        _server, base_url = start_server(standin, port=0)
+        print(f"🧪 Stand-in Gemini at {base_url}")
+    else:
+        print("⚠️ External stand-in: the harness cannot verify that requests actually reach it")
+
+    # 2. 覆盖 .env 中的配置 (load_dotenv 不会覆盖已存在的环境变量，因此这里的值优先)
+    os.environ["GEMINI_BASE_URL"] = base_url
+    os.environ["GOOGLE_API_KEY"] = "stand-in-key"  # 不把真实 Key 发给本地服务器
+    if args.low_memory:
+        os.environ["LOW_MEMORY_MODE"] = "1"
+        os.environ["IDLE_UNLOAD_SECONDS"] = str(args.idle_unload)
+
+    # 守护进程使用相对路径 (./logs, ./chroma_db)，统一从仓库根目录运行
+    os.chdir(REPO_ROOT)
+    os.makedirs("logs", exist_ok=True)
+    import lecture_agent_daemon as daemon
+    from agent_core import LectureAgentCore
+
+    vault_dir = args.vault or tempfile.mkdtemp(prefix="soak_vault_")
+    vault = SyntheticVault(vault_dir, args.notes, args.chat_ratio, args.link_ratio, args.typing)
+    daemon.OBSIDIAN_PATH = vault_dir
+    print(f"📂 Synthetic vault: {vault_dir} ({args.notes} notes)")
+
+    agent = LectureAgentCore()
+    if 0 < args.typing <= agent.prefetcher.stable_seconds + args.poll:
+        print(f"⚠️ --typing {args.typing}s is too short for prefetch "
+              f"(needs > {agent.prefetcher.stable_seconds + args.poll:.0f}s)")
+
+    # 分别记录 generate_note 全程 (门控 + 预取等待 + 检索 + LLM) 与单纯的 LLM 调用耗时
+    note_calls = []
+    llm_calls = []
+    generate_note = agent.generate_note
+
+    def timed_generate_note(text):
+        start = time.perf_counter()
+        try:
+            return generate_note(text)
+        finally:
+            note_calls.append((time.perf_counter() - start) * 1000)
+
+    agent.generate_note = timed_generate_note
+    agent.chain = TimedChain(agent.chain, llm_calls)
+
+    # 3. 主循环：写入 -> 扫描 (与守护进程 main 相同) -> 核对
+    e2e = []
+    memory = [(0.0, rss_mb())]
+    started = time.monotonic()
+    write_until = started + args.hours * 3600
+    next_write = started
+    next_report = started + args.report_every
+
+    def extras():
+        data = {
+            "gate": agent.gate.summary(),
+            "prefetch": agent.prefetcher.summary(),
+            "resources": agent.resources.summary(),
+        }
+        if standin is not None:
+            data["standin"] = dict(standin.stats)
+        return data
+
+    try:
+        while True:
+            now = time.monotonic()
+            writing = now < write_until
+            if not writing and (vault.pending() == 0 or now > write_until + args.drain):
+                break
+
+            while writing and now >= next_write:
+                vault.add_segment()
+                next_write += random.expovariate(args.rate / 60)
+
+            vault.close_due()
+            daemon.scan_and_process(agent)
+            agent.resources.maybe_unload()
+            e2e.extend(vault.poll())
+
+            # LLM 已被调用但替身一个请求都没收到：base_url 未生效，请求发去了真实端点
+            if standin is not None and llm_calls and standin.stats["requests"] == 0:
+                raise SystemExit(
+                    f"❌ {len(llm_calls)} LLM calls made but the stand-in at {base_url} received none. "
+                    "GEMINI_BASE_URL is not being honoured (langchain-google-genai>=4 is required)."
+                )
+
+            now = time.monotonic()
+            if now >= next_report:
+                memory.append((now - started, rss_mb()))
+                report = build_report(started, vault, e2e, note_calls, llm_calls, memory, extras())
+                logging.info(f"📊 Soak progress: {json.dumps(report, ensure_ascii=False)}")
+                next_report += args.report_every
+
+            time.sleep(args.poll)
+    except KeyboardInterrupt:
+        print("Interrupted, writing partial report...")
+
+    memory.append((time.monotonic() - started, rss_mb()))
+    agent.prefetcher.shutdown()
+
+    report = build_report(started, vault, e2e, note_calls, llm_calls, memory, extras())
+    report["correctness"] = vault.verify()
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+    if args.report_json:
+        with open(args.report_json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    if not args.vault:
+        shutil.rmtree(vault_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()